@@ -10,9 +10,11 @@ Loads configuration from config.ini and produces a configuration dictionary.
 www.delaneymorgan.com.au
 """
 
+import ast
 import configparser
 import json
 from enum import Enum
+from types import MappingProxyType
 
 
 # =============================================================================
@@ -27,9 +29,29 @@ class Sections(Enum):
 # Defines the various required configuration members and their types.
 GENERAL_MEMBERS = {'positive_poll_period': 'float', 'negative_poll_period': 'float'}
 REDIS_MEMBERS = {'host': 'string', 'port': 'integer', 'db_no': 'integer', 'key_detail': 'string',
-                 'key_summary': 'string'}
+                 'key_summary': 'string', 'channel': 'string'}
 DEVICES_MEMBERS = {'monitored_devices': 'dict'}
 
+# Values for members that may be left out of the configuration file.
+REDIS_DEFAULTS = {'channel': 'tracker:changes'}
+
+
+# =============================================================================
+
+
+def _parse_literal(text):
+    """
+    parse a dict or list configuration value without evaluating it as code
+
+    :param text: the raw configuration value
+    :return: the parsed value
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        # allow python literal syntax (e.g. single quotes) for older config files
+        return ast.literal_eval(text)
+
 
 # =============================================================================
 
@@ -40,8 +62,8 @@ class HomerConfig:
     # A list of parsers for given data types. Note that many are non-standard types that
     # we do special case handling for.
     configTypeParsers = {
-        'dict': lambda self, settings, section, member: eval(settings.get(section, member)),
-        'list': lambda self, settings, section, member: eval(settings.get(section, member)),
+        'dict': lambda self, settings, section, member: _parse_literal(settings.get(section, member)),
+        'list': lambda self, settings, section, member: _parse_literal(settings.get(section, member)),
         'string': lambda self, settings, section, member: settings.get(section, member),
         'integer': lambda self, settings, section, member: settings.getint(section, member),
         'bool': lambda self, settings, section, member: settings.getboolean(section, member),
@@ -55,15 +77,25 @@ class HomerConfig:
         settings.read(self.filename)
 
         self.config[Sections.GENERAL] = self._read_section(settings, Sections.GENERAL.name, GENERAL_MEMBERS)
-        self.config[Sections.REDIS] = self._read_section(settings, Sections.REDIS.name, REDIS_MEMBERS)
+        self.config[Sections.REDIS] = self._read_section(settings, Sections.REDIS.name, REDIS_MEMBERS,
+                                                         REDIS_DEFAULTS)
         self.config[Sections.DEVICES] = self._read_section(settings, Sections.DEVICES.name, DEVICES_MEMBERS)
+
+        # frequently used settings, resolved once
+        self.positive_poll_period = self.config[Sections.GENERAL]['positive_poll_period']
+        self.negative_poll_period = self.config[Sections.GENERAL]['negative_poll_period']
+        self.monitored_devices = self.config[Sections.DEVICES]['monitored_devices']
         return
 
-    def _read_section(self, settings, section_name, members):
+    def _read_section(self, settings, section_name, members, defaults=None):
         values = {}
         for member, member_type in members.items():
-            values[member] = self._parse_config_entry(settings, section_name, member, member_type)
-        return values
+            if defaults and member in defaults and not settings.has_option(section_name, member):
+                values[member] = defaults[member]
+            else:
+                values[member] = self._parse_config_entry(settings, section_name, member, member_type)
+        # read-only, as every caller shares the same section
+        return MappingProxyType(values)
 
     def _parse_config_entry(self, settings, section, member, member_type):
         return self.configTypeParsers[member_type](self, settings, section, member)
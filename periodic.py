@@ -8,12 +8,13 @@ Periodic module
 www.delaneymorgan.com.au
 """
 
+import heapq
 import math
 import threading
 import time
 
 
-gRunningFlag = True
+gStopping = threading.Event()
 
 
 # =============================================================================
@@ -25,9 +26,10 @@ class Periodic(object):
         self.task = task
         self.name = name
         self.notifier = notifier
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
         self.num_periods = -1
         self.last_time = 0
+        self._wake = threading.Event()
         return
 
     def set_period(self, period):
@@ -36,31 +38,87 @@ class Periodic(object):
         return
 
     def reset(self):
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
         self.num_periods = 0
+        self.wake()
+        return
+
+    def wake(self):
+        self._wake.set()
+        return
+
+    def wait(self, timeout):
+        # sleep until timeout, or until the schedule changes or someone calls wake()
+        self._wake.wait(timeout)
+        self._wake.clear()
         return
 
+    def next_due(self):
+        return self.start_time + (self.num_periods + 1) * self.period
+
+    def time_left(self):
+        remainder = (time.monotonic() - self.start_time) % self.period
+        return max(0, (self.period - remainder))
+
     def check(self):
-        time_now = time.time()
+        time_now = time.monotonic()
         elapsed_periods = math.floor((time_now - self.start_time) / self.period)
-        remainder = (time_now - self.start_time) % self.period
-        time_left = max(0, (self.period - remainder))
+        time_left = self.time_left()
         if elapsed_periods > self.num_periods:
-            self.num_periods += 1
+            missed = elapsed_periods - self.num_periods - 1
+            if missed > 0 and self.num_periods >= 0:
+                # we fell behind - skip the missed periods rather than running back to back to catch up
+                if self.notifier is not None:
+                    self.notifier.warning("%s missed %d period(s)", self.name, missed)
+                else:
+                    print("%s missed %d period(s)" % (self.name, missed))
+            self.num_periods = elapsed_periods
             self.last_time = time_now
             if self.name is not None:
                 if self.notifier is not None:
-                    self.notifier.diagnostic("doing %s" % self.name)
+                    self.notifier.diagnostic("doing %s", self.name)
                 else:
                     print("doing %s" % self.name)
             self.task()
-            return time_left
+            # the task may have taken a while, or changed the period
+            return self.time_left()
         return time_left
 
 
 # =============================================================================
 
 
+class Scheduler(object):
+    # Keeps a number of Periodics in a heap ordered by when each is next due, so only those
+    # actually due are checked.  A Periodic whose period is changed outside its own task is
+    # re-sorted the next time it comes up.
+    def __init__(self):
+        self._heap = []
+        self._count = 0
+        return
+
+    def add(self, periodic):
+        # the count breaks ties, so Periodics themselves are never compared
+        heapq.heappush(self._heap, (periodic.next_due(), self._count, periodic))
+        self._count += 1
+        return
+
+    def check(self):
+        time_now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= time_now:
+            due.append(heapq.heappop(self._heap))
+        for _, count, periodic in due:
+            periodic.check()
+            heapq.heappush(self._heap, (periodic.next_due(), count, periodic))
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.monotonic())
+
+
+# =============================================================================
+
+
 class Thread1(threading.Thread):
     # noinspection PyUnresolvedReferences
     def __init__(self):
@@ -75,10 +133,10 @@ class Thread1(threading.Thread):
         return
 
     def run(self):
-        while gRunningFlag:
+        while not gStopping.is_set():
             left1 = self.periodic1.check()
             print("Thread1: sleeping for: %5.4f sec" % left1)
-            time.sleep(left1)
+            gStopping.wait(left1)
         return
 
 
@@ -90,8 +148,9 @@ class Thread2(threading.Thread):
     def __init__(self):
         super(Thread2, self).__init__()
         self.start_time = time.time()
-        self.periodic2 = Periodic(15, self.do_task2)
-        self.periodic3 = Periodic(5, self.do_task3)
+        self.scheduler = Scheduler()
+        self.scheduler.add(Periodic(15, self.do_task2))
+        self.scheduler.add(Periodic(5, self.do_task3))
         return
 
     def do_task2(self):
@@ -105,12 +164,10 @@ class Thread2(threading.Thread):
         return
 
     def run(self):
-        while gRunningFlag:
-            left2 = self.periodic2.check()
-            left3 = self.periodic3.check()
-            sleep_time = min(left2, left3)
+        while not gStopping.is_set():
+            sleep_time = self.scheduler.check()
             print("Thread2: sleeping for: %5.4f sec" % sleep_time)
-            time.sleep(sleep_time)
+            gStopping.wait(sleep_time)
         return
 
 
@@ -124,9 +181,8 @@ if __name__ == "__main__":
     try:
         thread1.start()
         thread2.start()
-        while True:
-            pass
+        # nothing to do here until interrupted
+        gStopping.wait()
     except KeyboardInterrupt:
-        gRunningFlag = False
-        pass
+        gStopping.set()
     print("Periodic end")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Snapshot module
+
+Shares the latest tracker state with consumers on the same host via shared memory, so they
+needn't go through redis.
+
+The segment holds a sequence number and a length, followed by that many bytes of json.
+The sequence number is odd while a write is in progress, and changes with every write.
+
+© Delaney & Morgan Computing 2019
+www.delaneymorgan.com.au
+"""
+
+import json
+import mmap
+import struct
+import time
+from multiprocessing import shared_memory
+
+
+SNAPSHOT_NAME = "tracker_state"
+SNAPSHOT_SIZE = 4096
+
+HEADER = struct.Struct("<II")
+
+
+# =============================================================================
+
+
+class SnapshotWriter(object):
+    def __init__(self, name=SNAPSHOT_NAME, size=SNAPSHOT_SIZE):
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by an earlier run
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._sequence = 0
+        HEADER.pack_into(self._shm.buf, 0, self._sequence, 0)
+        return
+
+    def write(self, data):
+        if HEADER.size + len(data) > self._shm.size:
+            raise ValueError("snapshot of %d bytes too large for %s" % (len(data), self._shm.name))
+        HEADER.pack_into(self._shm.buf, 0, self._sequence + 1, 0)
+        self._shm.buf[HEADER.size:HEADER.size + len(data)] = data
+        self._sequence += 2
+        HEADER.pack_into(self._shm.buf, 0, self._sequence, len(data))
+        return
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+        return
+
+
+# =============================================================================
+
+
+def read_snapshot(name=SNAPSHOT_NAME, retries=10):
+    """
+    read the latest snapshot written by a SnapshotWriter
+
+    :param name: the name of the shared memory segment
+    :param retries: how many times to retry if caught mid-write
+    :return: the decoded snapshot, or None if the tracker isn't running or no consistent snapshot could be read
+    """
+    # mapped directly rather than via SharedMemory, which would unlink the segment when we exit
+    try:
+        f = open("/dev/shm/%s" % name, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for _ in range(retries):
+                sequence, length = HEADER.unpack_from(buf, 0)
+                data = buf[HEADER.size:HEADER.size + length]
+                if not (sequence & 1) and HEADER.unpack_from(buf, 0)[0] == sequence:
+                    return json.loads(data) if length else None
+                time.sleep(0.001)
+    return None
+
+
+# =============================================================================
+
+
+if __name__ == "__main__":
+    print(json.dumps(read_snapshot(), indent=4))
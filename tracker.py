@@ -13,16 +13,23 @@ www.delaneymorgan.com.au
 """
 
 import argparse
-import json
+import concurrent.futures
+import icmplib
+import orjson
 import os
-import pyping
+import queue
 import random
 import redis
+import socket
+import subprocess
 import sys
 import threading
 import time
 
+from collections import defaultdict
+
 from periodic import Periodic
+from snapshot import SnapshotWriter
 from config import HomerConfig
 
 __VERSION__ = "1.0.0"
@@ -31,42 +38,56 @@ CONFIG_FILENAME = "config.ini"
 
 USE_THREADING = False
 USE_PYPING = False
+USE_ICMPLIB = True
+USE_SNAPSHOT = True
+
+# seconds between attempts to write to redis after a failure
+REDIS_RETRY_PERIOD = 5
+
+# missing devices are polled less often, backing off to at most this many poll periods
+MISSING_BACKOFF_LIMIT = 16
 
 
 # =============================================================================
 
 
 class Notifier(object):
+    # the last timestamp formatted, and the second it was for - kept together so threads always see a matching pair
+    _timestamp = (0, "")
+
     def __init__(self, args):
         self._args = args
         return
 
-    @staticmethod
-    def _inform(string):
-        print("%s: %s" % (time.strftime("%Y/%m/%d %H:%M:%S"), string))
-        sys.stdout.flush()  # force print to flush
+    @classmethod
+    def _inform(cls, string):
+        second = int(time.time())
+        if second != cls._timestamp[0]:
+            cls._timestamp = (second, time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(second)))
+        print("%s: %s" % (cls._timestamp[1], string))
         return
 
-    def note(self, string):
+    def note(self, fmt, *args):
+        # formatting is deferred until we know the note will be shown
         if self._args.verbose or self._args.diagnostic:
-            self._inform(string)
+            self._inform(fmt % args if args else fmt)
         return
 
-    def warning(self, string):
-        self._inform("Warning: %s" % string)
+    def warning(self, fmt, *args):
+        self._inform("Warning: %s" % (fmt % args if args else fmt))
         return
 
-    def error(self, string):
-        self._inform("Error: %s" % string)
+    def error(self, fmt, *args):
+        self._inform("Error: %s" % (fmt % args if args else fmt))
         return
 
-    def diagnostic(self, string):
+    def diagnostic(self, fmt, *args):
         if self._args.diagnostic:
-            self._inform("Diagnostic: %s" % string)
+            self._inform("Diagnostic: %s" % (fmt % args if args else fmt))
         return
 
-    def fatal(self, string):
-        self._inform("Fatal: %s" % string)
+    def fatal(self, fmt, *args):
+        self._inform("Fatal: %s" % (fmt % args if args else fmt))
         # noinspection PyProtectedMember
         os._exit(1)
         return
@@ -75,78 +96,219 @@ class Notifier(object):
 # =============================================================================
 
 
+class RedisWriter(threading.Thread):
+    # writes to redis in the background, so polling never waits on redis
+    def __init__(self, rdb, channel, notifier):
+        super(RedisWriter, self).__init__()
+        self.daemon = True
+        self._rdb = rdb
+        self._channel = channel
+        self._notifier = notifier
+        self._queue = queue.Queue()
+        return
+
+    def write(self, values, message):
+        self._queue.put_nowait((values, message))
+        return
+
+    def run(self):
+        # values not yet written, kept after a failed write so they're retried
+        unwritten = {}
+        message = None
+        while True:
+            try:
+                values, message = self._queue.get(timeout=REDIS_RETRY_PERIOD if unwritten else None)
+                unwritten.update(values)
+            except queue.Empty:
+                pass
+            # coalesce anything queued meanwhile - only the latest value of each key, and the latest message, matter
+            try:
+                while True:
+                    values, message = self._queue.get_nowait()
+                    unwritten.update(values)
+            except queue.Empty:
+                pass
+            try:
+                pipe = self._rdb.pipeline(transaction=False)
+                pipe.mset(unwritten)
+                # tell subscribers, so they needn't poll the keys
+                pipe.publish(self._channel, message)
+                pipe.execute()
+                unwritten = {}
+            except redis.RedisError as ex:
+                self._notifier.error("redis write failed, retrying in %d sec: %s", REDIS_RETRY_PERIOD, ex)
+
+
+# =============================================================================
+
+
 class Tracker(threading.Thread):
     def __init__(self, args, config, notifier):
         super(Tracker, self).__init__()
         self._args = args
         self._config = config
-        self._monitored_devices = config.devices_details()["monitored_devices"]
+        # devices are fixed for the life of the tracker
+        self._device_items = tuple(config.monitored_devices.items())
         self._notifer = notifier
-        positive_poll_period = config.general_details()["positive_poll_period"]
-        negative_poll_period = config.general_details()["negative_poll_period"]
-        self._poll = Periodic(negative_poll_period, self.poll_devices, "poll_devices", notifier=notifier)
+        self._positive_poll_period = config.positive_poll_period
+        self._negative_poll_period = config.negative_poll_period
+        self._poll = Periodic(self._negative_poll_period, self.poll_devices, "poll_devices", notifier=notifier)
         redis_info = config.redis_details()
-        self._rdb = redis.StrictRedis(host=redis_info["host"], port=redis_info["port"], db=redis_info["db_no"])
+        pool = redis.ConnectionPool(host=redis_info["host"], port=redis_info["port"], db=redis_info["db_no"],
+                                    max_connections=4, socket_keepalive=True,
+                                    socket_keepalive_options={socket.TCP_KEEPIDLE: 30})
+        self._writer = RedisWriter(redis.StrictRedis(connection_pool=pool), redis_info["channel"], notifier)
+        self._key_detail = redis_info["key_detail"]
+        self._key_summary = redis_info["key_summary"]
+        self._snapshot = None
+        if USE_SNAPSHOT:
+            try:
+                self._snapshot = SnapshotWriter()
+            except OSError as ex:
+                # e.g. a segment left by another user, or no /dev/shm - carry on without the snapshot
+                notifier.warning("snapshot unavailable: %s", ex)
         self._roll_call = {}
+        self._any_detected = False
+        self._last_detail = None
+        self._last_summary = None
+        self._fail_streak = defaultdict(int)
+        self._polls_to_skip = defaultdict(int)
+        # turned off for the rest of the run if icmp sockets turn out not to be allowed
+        self._use_icmplib = USE_ICMPLIB
+        self._stopping = threading.Event()
         return
 
     def any_detected(self):
-        for thisDevice, presence in self._roll_call.items():
-            if presence:
-                return True
-        return False
+        return self._any_detected
 
     def poll_devices(self):
-        roll_call = {}
-        redis_info = config.redis_details()
         previously_detected = self.any_detected()
-        any_detected = False
-        for name, address in self._monitored_devices.items():
-            self._notifer.diagnostic("pinging %s at %s" % (name, address))
-            found = self.ping(address)
-            if found:
-                any_detected = True
+        due_devices = {}
+        for name, address in self._device_items:
+            # backoff is counted in polls, so it follows any change in the poll period
+            if self._polls_to_skip[name] > 0:
+                self._polls_to_skip[name] -= 1
+            else:
+                self._notifer.diagnostic("pinging %s at %s", name, address)
+                due_devices[name] = address
+        results = self.ping_many(due_devices.values())
+        roll_call = {}
+        for name, address in self._device_items:
+            if name not in due_devices:
+                # still backing off - assume nothing has changed
+                roll_call[name] = self._roll_call.get(name, False)
+            elif results[address]:
                 roll_call[name] = True
-                self._notifer.note("%s found" % name)
+                self._fail_streak[name] = 0
             else:
                 roll_call[name] = False
-                self._notifer.note("%s missing" % name)
+                self._fail_streak[name] += 1
+                backoff = min(2 ** self._fail_streak[name], MISSING_BACKOFF_LIMIT)
+                self._polls_to_skip[name] = backoff - 1
+        any_detected = any(roll_call.values())
+        for name, found in roll_call.items():
+            if found:
+                self._notifer.note("%s found", name)
+            else:
+                self._notifer.note("%s missing", name)
                 if previously_detected:
                     self._poll.reset()
 
         # set up next poll
         if any_detected and not previously_detected:
-            self._poll.set_period(config.general_details()["positive_poll_period"])
+            self._poll.set_period(self._positive_poll_period)
         elif not any_detected and previously_detected:
-            self._poll.set_period(config.general_details()["negative_poll_period"])
+            self._poll.set_period(self._negative_poll_period)
 
         self._roll_call = roll_call
-        self._rdb.set(redis_info["key_detail"], json.dumps(roll_call))
-        self._rdb.set(redis_info["key_summary"], json.dumps(any_detected))
+        self._any_detected = any_detected
+        # only write the keys that have changed
+        changes = {}
+        detail = orjson.dumps(roll_call, option=orjson.OPT_SORT_KEYS)
+        if detail != self._last_detail:
+            changes[self._key_detail] = detail
+            self._last_detail = detail
+        summary = orjson.dumps(any_detected)
+        if summary != self._last_summary:
+            changes[self._key_summary] = summary
+            self._last_summary = summary
+        if changes:
+            state = orjson.dumps({"roll_call": roll_call, "any_detected": any_detected})
+            self._writer.write(changes, state)
+            if self._snapshot is not None:
+                try:
+                    self._snapshot.write(state)
+                except ValueError as ex:
+                    # the snapshot is only a convenience for local consumers - don't stop polling over it
+                    self._notifer.warning("snapshot not written: %s", ex)
         return
 
+    def ping_many(self, addresses):
+        """
+        ping a number of devices at once
+
+        :param addresses: the ip addresses to ping
+        :return: a dictionary of address to presence
+        """
+        addresses = list(addresses)
+        if not addresses:
+            return {}
+        if self._use_icmplib and not self._args.test:
+            try:
+                # all echo requests go out on the one socket, so a poll costs one timeout rather than one per device
+                hosts = icmplib.multiping(addresses, count=1, timeout=1, privileged=(os.geteuid() == 0))
+                # hosts come back in the order asked, and host.address is the resolved ip, so pair them up by position
+                return dict(zip(addresses, (host.is_alive for host in hosts)))
+            except icmplib.SocketPermissionError as ex:
+                # this won't change while we run, so don't try (and warn) again every poll
+                self._use_icmplib = False
+                self._notifer.warning("icmp sockets not allowed, pinging devices individually from now on: %s", ex)
+            except icmplib.ICMPLibError as ex:
+                # e.g. an unresolvable hostname
+                self._notifer.warning("multiping failed, pinging devices individually: %s", ex)
+        # one ping at a time would cost the sum of the timeouts - run them side by side instead
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(addresses)) as executor:
+            return dict(zip(addresses, executor.map(self.ping, addresses)))
+
     def ping(self, ip_address):
         # NOTE: ping requires root access.  Fake it during development with a random#
-        if hasattr(args, 'test') and args.test:
+        if self._args.test:
             found = (random.randint(0, 3) == 3)
         elif USE_PYPING:
+            # only imported when wanted - pyping doesn't support python 3
+            import pyping
             response = pyping.ping(ip_address)
             found = (response.ret_code == 0)
         else:
-            response = os.system("ping -c i %s" % ip_address)
-            found = (response == 0)
+            try:
+                response = subprocess.run(["ping", "-c", "1", "-W", "1", ip_address],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                found = (response.returncode == 0)
+            except OSError as ex:
+                self._notifer.warning("could not run ping: %s", ex)
+                found = False
         return found
 
     def roll_call(self):
         return self._roll_call
 
     def check(self):
-        self._poll.check()
+        return self._poll.check()
+
+    def stop(self):
+        self._stopping.set()
+        self._poll.wake()
         return
 
     def run(self):
-        while gRunningFlag:
-            self.check()
+        self._writer.start()
+        # sleep until the next poll is due, waking early if the poll period changes or we're asked to stop
+        try:
+            while not self._stopping.is_set():
+                self._poll.wait(self.check())
+        finally:
+            if self._snapshot is not None:
+                self._snapshot.close()
         return
 
 
@@ -169,21 +331,20 @@ def arg_parser():
 
 
 if __name__ == "__main__":
+    # flush each line as it's written, even when not on a terminal (e.g. under systemd)
+    sys.stdout.reconfigure(line_buffering=True)
     print("Tracker start")
     args = arg_parser()
     notifier = Notifier(args)
     config = HomerConfig(CONFIG_FILENAME)
     # noinspection PyTypeChecker
     tracker = Tracker(args, config, notifier)
-    if USE_THREADING:
-        tracker.start()
-    else:
-        try:
-            while True:
-                tracker.check()
-                # notifier.note("roll call: %s" % tracker.roll_call())
-                time.sleep(1)
-        except KeyboardInterrupt:
-            gRunningFlag = False
-            pass
+    try:
+        if USE_THREADING:
+            tracker.start()
+            tracker.join()
+        else:
+            tracker.run()
+    except KeyboardInterrupt:
+        tracker.stop()
     print("Tracker end")